@@ -1,20 +1,59 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import multiprocessing
 import os
-import pcbnew
 import shutil
+import sys
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
+# Buffer size for the userspace fallback copy. shutil's default of
+# 64 KiB causes many more syscalls than necessary on multi-MB boards.
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Minimum number of traces before key extraction is parallelized.
+# Below this the thread pool overhead outweighs the gain.
+PARALLEL_KEY_THRESHOLD = 10000
+
+# pcbnew coordinates are in nanometers.
+NM_PER_MM = 1000000
+
 
 class ErgogenHelperException(Exception):
     pass
 
 
+def copy_file(src_path, dst_path):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src_path, 'rb') as f_in, \
+                 open(dst_path, 'wb') as f_out:
+                remaining = os.fstat(f_in.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(
+                        f_in.fileno(), f_out.fileno(), remaining
+                    )
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            return
+        except OSError:
+            # Not supported for this filesystem combination,
+            # fall back to a regular buffered copy.
+            pass
+
+    with open(src_path, 'rb') as f_in, open(dst_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, length=COPY_BUFFER_SIZE)
+
+
 def get_traces(pcb):
     try:
-        traces = pcb.GetTracks()
+        traces = list(pcb.GetTracks())
     except Exception as e:
         err = f'ERROR: Could not get traces: {e}'
         raise ErgogenHelperException(err) from e
@@ -23,76 +62,170 @@ def get_traces(pcb):
 
 
 def check_traces_equal(trace_1, trace_2):
-    if (trace_1.GetStart() == trace_2.GetStart() and
-       trace_1.GetEnd() == trace_2.GetEnd()):
+    start_1 = trace_1.GetStart()
+    end_1 = trace_1.GetEnd()
+    start_2 = trace_2.GetStart()
+    end_2 = trace_2.GetEnd()
+
+    if start_1 == start_2 and end_1 == end_2:
         return True
     else:
         return False
 
 
 def pcb_has_trace(pcb, lookup_trace):
-    traces = pcb.GetTracks()
-
-    for pcb_trace in traces:
-        if check_traces_equal(lookup_trace, pcb_trace) is True:
-            return True
+    lookup_start = lookup_trace.GetStart()
+    lookup_end = lookup_trace.GetEnd()
 
-    return False
+    return any(
+        pcb_trace.GetStart() == lookup_start and
+        pcb_trace.GetEnd() == lookup_end
+        for pcb_trace in pcb.GetTracks()
+    )
 
 
 def get_trace_descr(trace):
-    start_x = trace.GetStart()[0] / 1000000
-    start_y = trace.GetStart()[1] / 1000000
-    end_x = trace.GetEnd()[0] / 1000000
-    end_y = trace.GetEnd()[1] / 1000000
-    length = trace.GetLength() / 1000000
-
-    return f'({start_x}, {start_y}) -> ({end_x}, {end_y}) ({length}mm)'
-
+    start = trace.GetStart()
+    end = trace.GetEnd()
 
-def filter_existing_traces(traces, pcb):
-    filtered_traces = []
-    for trace in traces:
-        if pcb_has_trace(pcb, trace) is False:
-            filtered_traces.append(trace)
+    start_x = start[0] / NM_PER_MM
+    start_y = start[1] / NM_PER_MM
+    end_x = end[0] / NM_PER_MM
+    end_y = end[1] / NM_PER_MM
+    length = trace.GetLength() / NM_PER_MM
 
-    removed_count = len(traces) - len(filtered_traces)
+    return f'({start_x}, {start_y}) -> ({end_x}, {end_y}) ({length}mm)'
 
-    return (removed_count, filtered_traces)
 
+def make_trace_key(start_x, start_y, end_x, end_y):
+    # Order the endpoints canonically so a trace with swapped start
+    # and end still counts as the same segment.
+    start = (start_x, start_y)
+    end = (end_x, end_y)
 
-def filter_locked_traces(traces):
-    filtered_traces = []
-    for trace in traces:
-        if trace.IsLocked() is False:
-            filtered_traces.append(trace)
+    return (start, end) if start <= end else (end, start)
 
-    removed_count = len(traces) - len(filtered_traces)
 
-    return (removed_count, filtered_traces)
+def get_trace_key(trace):
+    start = trace.GetStart()
+    end = trace.GetEnd()
 
+    return make_trace_key(start[0], start[1], end[0], end[1])
 
-def copy_traces(src_pcb, dst_pcb, unlocked_only=False):
-    traces = get_traces(src_pcb)
-    traces_total = len(traces)
 
-    if unlocked_only is True:
-        locked_num, traces = filter_locked_traces(traces)
-        if locked_num > 0:
-            print(f'WARN: Skipped {locked_num} locked traces')
+# One row per trace with its attributes read from pcbnew exactly once,
+# so the filter stages below can work on plain Python values.
+TraceRow = namedtuple(
+    'TraceRow',
+    ['start_x', 'start_y', 'end_x', 'end_y', 'locked', 'trace']
+)
 
-    existing_num, traces = filter_existing_traces(traces, dst_pcb)
-    if existing_num > 0:
-        print(f'WARN: Skipped {existing_num} existing traces')
 
+def extract_trace_rows(traces):
+    rows = []
     for trace in traces:
+        start = trace.GetStart()
+        end = trace.GetEnd()
+        rows.append(TraceRow(
+            start[0], start[1], end[0], end[1], trace.IsLocked(), trace
+        ))
+
+    return rows
+
+
+def get_trace_keys(traces, jobs=None):
+    # pcbnew's SWIG calls release the GIL while the C++ side runs, so
+    # key extraction for big boards benefits from a thread pool.
+    if len(traces) >= PARALLEL_KEY_THRESHOLD and jobs != 1:
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as ex:
+            return set(ex.map(get_trace_key, traces, chunksize=1024))
+
+    return {get_trace_key(trace) for trace in traces}
+
+
+def filter_existing_traces(rows, dst_traces, jobs=None):
+    existing_keys = get_trace_keys(dst_traces, jobs)
+
+    skipped_rows = []
+    filtered_rows = []
+    for row in rows:
+        key = make_trace_key(row.start_x, row.start_y, row.end_x, row.end_y)
+        if key in existing_keys:
+            skipped_rows.append(row)
+        else:
+            filtered_rows.append(row)
+
+    return (skipped_rows, filtered_rows)
+
+
+def filter_locked_traces(rows):
+    skipped_rows = []
+    filtered_rows = []
+    for row in rows:
+        if row.locked:
+            skipped_rows.append(row)
+        else:
+            filtered_rows.append(row)
+
+    return (skipped_rows, filtered_rows)
+
+
+def warn_skipped_traces(reason, rows, verbose=False):
+    msg = f'WARN: Skipped {len(rows)} {reason} traces'
+    if verbose:
+        descrs = '\n  '.join(get_trace_descr(row.trace) for row in rows)
+        msg = f'{msg}:\n  {descrs}'
+
+    # A single write instead of one print per trace, so many skipped
+    # traces don't cause thousands of stderr flushes.
+    sys.stderr.write(msg + '\n')
+
+
+def copy_traces(src_pcb, dst_pcb, unlocked_only=False, jobs=None,
+                verbose=False):
+    rows = extract_trace_rows(get_traces(src_pcb))
+    traces_total = len(rows)
+
+    if unlocked_only:
+        locked_rows, rows = filter_locked_traces(rows)
+        if locked_rows:
+            warn_skipped_traces('locked', locked_rows, verbose)
+
+    dst_traces = get_traces(dst_pcb)
+    existing_rows, rows = filter_existing_traces(rows, dst_traces, jobs)
+    if existing_rows:
+        warn_skipped_traces('existing', existing_rows, verbose)
+
+    import pcbnew
+
+    # Adding through a board commit defers the connectivity and
+    # spatial index rebuild until Push, so it runs once for the whole
+    # batch instead of once per trace. Current SWIG bindings don't
+    # wrap BOARD_COMMIT (and builds that do may not accept a BOARD),
+    # so only the construction is a capability probe. Once Add/Push
+    # have started mutating the board, a failure must not fall back to
+    # re-adding the same traces.
+    commit = None
+    board_commit_cls = getattr(pcbnew, 'BOARD_COMMIT', None)
+    if board_commit_cls is not None:
         try:
-            dst_pcb.Add(trace)
-        except Exception as e:
-            err = f'Could not copy trace: {e}'
-            raise ErgogenHelperException(err) from e
+            commit = board_commit_cls(dst_pcb)
+        except Exception:
+            commit = None
+
+    try:
+        if commit is not None:
+            for row in rows:
+                commit.Add(row.trace)
+            commit.Push('Copy traces')
+        else:
+            for row in rows:
+                dst_pcb.Add(row.trace)
+    except Exception as e:
+        err = f'Could not copy traces: {e}'
+        raise ErgogenHelperException(err) from e
 
-    print(f'Copied {len(traces)} / {traces_total} traces.')
+    print(f'Copied {len(rows)} / {traces_total} traces.')
 
 
 def lock_traces(pcb):
@@ -104,78 +237,152 @@ def lock_traces(pcb):
     print(f'Locked {len(traces)} traces...')
 
 
+def pcb_needs_update(pcb):
+    import pcbnew
+
+    try:
+        loaded_version = pcb.GetFileFormatVersionAtLoad()
+        current_version = pcbnew.SEXPR_BOARD_FILE_VERSION
+    except AttributeError:
+        # Older pcbnew builds don't expose the format version, so
+        # assume the save is needed.
+        return True
+
+    return loaded_version < current_version
+
+
 def save_pcb(pcb, should_backup, backup_name):
-    pcb_path = pcb.GetFileName()
-    pcb_path = Path(pcb_path)
+    pcb_path_raw = pcb.GetFileName()
+    pcb_path = Path(pcb_path_raw)
 
-    if should_backup is True and os.path.exists(pcb_path):
-        backup_path = pcb_path.with_stem(f'{pcb_path.stem}_{backup_name}')
+    if should_backup:
+        backup_path = str(
+            pcb_path.with_stem(f'{pcb_path.stem}_{backup_name}')
+        )
         try:
-            shutil.copy(str(pcb_path), str(backup_path))
+            copy_file(pcb_path_raw, backup_path)
+        except FileNotFoundError:
+            # The pcb hasn't been saved before, so there is nothing
+            # to back up.
+            pass
         except Exception as e:
             err = f'Could not backup pcb to {backup_path}: {e}'
             raise ErgogenHelperException(err) from e
 
     try:
-        pcb.Save(pcb_path)
+        pcb.Save(pcb_path_raw)
     except Exception as e:
-        err = f'Could not save pcb to {pcb_path}: {e}'
+        err = f'Could not save pcb to {pcb_path_raw}: {e}'
         raise ErgogenHelperException(err) from e
 
 
 def cmd_copy_traces(args):
+    # Imported here so that --help and argument errors don't pay for
+    # loading KiCad's C++ module.
+    import pcbnew
+
     try:
         src_pcb = pcbnew.LoadBoard(args.src_pcb_path)
         dst_pcb = pcbnew.LoadBoard(args.dst_pcb_path)
 
-        copy_traces(src_pcb, dst_pcb, args.unlocked_only)
+        copy_traces(
+            src_pcb, dst_pcb, args.unlocked_only, args.jobs, args.verbose
+        )
         save_pcb(dst_pcb, not args.no_backup, args.backup_name)
     except ErgogenHelperException as e:
         print(f'ERROR: {e}')
         exit(-1)
 
 
-def cmd_update_pcb(args):
+def expand_pcb_paths(pattern):
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        # Keep the literal path so the worker reports the usual
+        # load error for a missing file.
+        paths = [pattern]
+
+    return paths
+
+
+def run_for_each_pcb(worker, pcb_paths, jobs=None):
+    if len(pcb_paths) > 1 and jobs != 1:
+        # Separate processes instead of threads, because pcbnew keeps
+        # global C++ state per process.
+        with multiprocessing.Pool(jobs or os.cpu_count()) as pool:
+            results = pool.map(worker, pcb_paths)
+    else:
+        results = [worker(pcb_path) for pcb_path in pcb_paths]
+
+    errors = [result for result in results if result is not None]
+    for error in errors:
+        print(f'ERROR: {error}')
+    if errors:
+        exit(-1)
+
+
+def load_pcb_worker(pcb_path):
+    import pcbnew
+
+    # LoadBoard raises IOError for missing or corrupt files; wrap it
+    # so one bad path doesn't abort the rest of the batch.
     try:
-        pcb = pcbnew.LoadBoard(args.pcb_path)
-        save_pcb(pcb, not args.no_backup, args.backup_name)
+        return pcbnew.LoadBoard(pcb_path)
+    except Exception as e:
+        err = f'Could not load pcb {pcb_path}: {e}'
+        raise ErgogenHelperException(err) from e
+
+
+def update_pcb_worker(pcb_path, should_backup, backup_name):
+    try:
+        pcb = load_pcb_worker(pcb_path)
+        if not pcb_needs_update(pcb):
+            print(f'{pcb_path} is already up-to-date.')
+            return None
+        save_pcb(pcb, should_backup, backup_name)
     except ErgogenHelperException as e:
-        print(f'ERROR: {e}')
-        exit(-1)
+        return str(e)
 
+    return None
 
-def cmd_lock_traces(args):
+
+def lock_traces_worker(pcb_path, should_backup, backup_name):
     try:
-        pcb = pcbnew.LoadBoard(args.pcb_path)
+        pcb = load_pcb_worker(pcb_path)
         lock_traces(pcb)
-        save_pcb(pcb, not args.no_backup, args.backup_name)
+        save_pcb(pcb, should_backup, backup_name)
     except ErgogenHelperException as e:
-        print(f'ERROR: {e}')
-        exit(-1)
+        return str(e)
 
+    return None
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Utility to make ergogen keyboard development easier.'
-    )
-    subparsers = parser.add_subparsers(title='command', dest='cmd')
 
-    parser.add_argument(
-        '-n', '--backup-name',
-        default="orig",
-        help=(
-            'String to append to the filename of the backup '
-            '(default: %(default)s)'
-        )
+def cmd_update_pcb(args):
+    worker = partial(
+        update_pcb_worker,
+        should_backup=not args.no_backup,
+        backup_name=args.backup_name,
     )
-    parser.add_argument(
-        '-b', '--no-backup',
-        default=False,
-        action='store_true',
-        help='Skip backup of PCB (default: %(default)s)'
+    run_for_each_pcb(worker, expand_pcb_paths(args.pcb_path), args.jobs)
+
+
+def cmd_lock_traces(args):
+    worker = partial(
+        lock_traces_worker,
+        should_backup=not args.no_backup,
+        backup_name=args.backup_name,
     )
+    run_for_each_pcb(worker, expand_pcb_paths(args.pcb_path), args.jobs)
+
+
+def jobs_arg(value):
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+
+    return jobs
+
 
-    # Command: copy-traces
+def add_copy_traces_parser(subparsers):
     copy_traces_parser = subparsers.add_parser(
         'copy-traces',
         help='Copy traces from source PCB to destination PCB'
@@ -197,33 +404,113 @@ def main():
             '(default: %(default)s)'
         )
     )
+    copy_traces_parser.add_argument(
+        '-j', '--jobs',
+        default=None,
+        type=jobs_arg,
+        help=(
+            'Number of worker threads for trace comparison on large '
+            'boards (default: number of CPUs)'
+        )
+    )
+    copy_traces_parser.add_argument(
+        '-v', '--verbose',
+        default=False,
+        action='store_true',
+        help=(
+            'List each skipped trace instead of only the count '
+            '(default: %(default)s)'
+        )
+    )
     copy_traces_parser.set_defaults(func=cmd_copy_traces)
 
-    # Subcommand: lock-traces
-    update_pcb = subparsers.add_parser(
+
+def add_lock_traces_parser(subparsers):
+    lock_traces_parser = subparsers.add_parser(
         'lock-traces',
         help=(
             'Sets all traces inside a KiCad PCB file to locked.'
         )
     )
-    update_pcb.add_argument(
+    lock_traces_parser.add_argument(
         'pcb_path',
-        help='The KiCad PCB file path.'
+        help='The KiCad PCB file path (or glob pattern).'
+    )
+    lock_traces_parser.add_argument(
+        '-j', '--jobs',
+        default=None,
+        type=jobs_arg,
+        help=(
+            'Number of worker processes when multiple PCBs match '
+            '(default: number of CPUs)'
+        )
     )
-    update_pcb.set_defaults(func=cmd_lock_traces)
+    lock_traces_parser.set_defaults(func=cmd_lock_traces)
 
-    # Subcommand: update-pcb
-    update_pcb = subparsers.add_parser(
+
+def add_update_pcb_parser(subparsers):
+    update_pcb_parser = subparsers.add_parser(
         'update-pcb',
         help=(
             'Update KiCad pcb from v5 to v7 by opening it and saving it again.'
         )
     )
-    update_pcb.add_argument(
+    update_pcb_parser.add_argument(
         'pcb_path',
-        help='The KiCad PCB file path.'
+        help='The KiCad PCB file path (or glob pattern).'
+    )
+    update_pcb_parser.add_argument(
+        '-j', '--jobs',
+        default=None,
+        type=jobs_arg,
+        help=(
+            'Number of worker processes when multiple PCBs match '
+            '(default: number of CPUs)'
+        )
+    )
+    update_pcb_parser.set_defaults(func=cmd_update_pcb)
+
+
+CLI_COMMANDS = {
+    'copy-traces': add_copy_traces_parser,
+    'lock-traces': add_lock_traces_parser,
+    'update-pcb': add_update_pcb_parser,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Utility to make ergogen keyboard development easier.'
+    )
+    subparsers = parser.add_subparsers(title='command', dest='cmd')
+
+    parser.add_argument(
+        '-n', '--backup-name',
+        default="orig",
+        help=(
+            'String to append to the filename of the backup '
+            '(default: %(default)s)'
+        )
     )
-    update_pcb.set_defaults(func=cmd_update_pcb)
+    parser.add_argument(
+        '-b', '--no-backup',
+        default=False,
+        action='store_true',
+        help='Skip backup of PCB (default: %(default)s)'
+    )
+
+    # Only build the subparser for the invoked command to keep startup
+    # fast. Just the first argument is considered, so that option
+    # values that happen to match a command name can't select the
+    # wrong subparser. Whenever it isn't a known command (global
+    # options first, help, typos) all subparsers are built so argparse
+    # can show the full usage info.
+    requested_cmd = sys.argv[1] if len(sys.argv) > 1 else None
+    if requested_cmd in CLI_COMMANDS:
+        CLI_COMMANDS[requested_cmd](subparsers)
+    else:
+        for add_parser_func in CLI_COMMANDS.values():
+            add_parser_func(subparsers)
 
     args = parser.parse_args()
 